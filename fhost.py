@@ -23,12 +23,16 @@ from flask import Flask, abort, make_response, redirect, render_template, \
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from werkzeug.datastructures import FileStorage
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, event, literal, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declared_attr
 import sqlalchemy.types as types
 from jinja2.exceptions import *
 from jinja2 import ChoiceLoader, FileSystemLoader
-from hashlib import file_digest
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from magic import Magic
 from mimetypes import guess_extension
 import click
@@ -36,15 +40,17 @@ import enum
 import os
 import sys
 import time
+import base64
 import datetime
 import ipaddress
-import io
 import typing
 import requests
-import secrets
-import shutil
+import sqlite3
+import tempfile
+import threading
 import re
 from validators import url as url_valid
+from urllib.parse import quote, urlsplit
 from pathlib import Path
 
 app = Flask(__name__, instance_relative_config=True)
@@ -99,17 +105,75 @@ if app.config["NSFW_DETECT"]:
     from nsfw_detect import NSFWDetector
     nsfw = NSFWDetector()
 
+_mime_tls = threading.local()
+
 try:
-    mimedetect = Magic(mime=True, mime_encoding=False)
+    _mime_tls.m = Magic(mime=True, mime_encoding=False)
 except TypeError:
     print("""Error: You have installed the wrong version of the 'magic' module.
 Please install python-magic.""")
     sys.exit(1)
 
+
+def mimedetect() -> Magic:
+    # libmagic is not thread-safe and the python wrapper serializes all
+    # calls on a single lock, so every thread gets its own instance
+    m = getattr(_mime_tls, "m", None)
+    if m is None:
+        m = _mime_tls.m = Magic(mime=True, mime_encoding=False)
+    return m
+
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
 
+@event.listens_for(Engine, "connect")
+def _sqlite_regexp(dbapi_con, con_record):
+    # Give SQLite a REGEXP implementation so regex filters can be
+    # matched inside the engine (match semantics, like HasRegex.check)
+    if isinstance(dbapi_con, sqlite3.Connection):
+        dbapi_con.create_function(
+            "regexp", 2,
+            lambda pattern, s: re.match(pattern, s) is not None,
+            deterministic=True)
+
+
+try:
+    # Optional C binding to libcperciva's SHA-NI transform; considerably
+    # faster than a generic OpenSSL build on CPUs with the SHA extensions.
+    from sha256_ni import sha256 as _sha256
+except ImportError:
+    _sha256 = hashlib.sha256
+
+
+class _TokenPool:
+    """Hands out URL-safe random tokens from a buffered entropy pool so
+    hot paths don't pay a getrandom() syscall per token."""
+
+    def __init__(self, chunk=4096):
+        self.chunk = chunk
+        self.buf = b""
+        self.lock = threading.Lock()
+
+    def drop(self):
+        self.buf = b""
+
+    def get(self, n=16) -> str:
+        with self.lock:
+            if len(self.buf) < n:
+                self.buf = os.urandom(self.chunk)
+            tok, self.buf = self.buf[:n], self.buf[n:]
+        return base64.urlsafe_b64encode(tok).rstrip(b"=").decode()
+
+
+_tokens = _TokenPool()
+
+# Forked children (scan pool, preforking servers) must not share
+# buffered entropy with the parent
+os.register_at_fork(after_in_child=_tokens.drop)
+
+
 class URL(db.Model):
     __tablename__ = "URL"
     id = db.Column(db.Integer, primary_key=True)
@@ -122,17 +186,42 @@ class URL(db.Model):
         return su.enbase(self.id)
 
     def geturl(self):
-        return url_for("get", path=self.getname(), _external=True) + "\n"
+        return f"{external_base()}/{self.getname()}\n"
 
     @staticmethod
     def get(url):
-        u = URL.query.filter_by(url=url).first()
+        match db.session.get_bind().dialect.name:
+            case "sqlite":
+                stmt = sqlite_insert(URL)
+            case "postgresql":
+                stmt = pg_insert(URL)
+            case _:
+                # No upsert support; fall back to select-then-insert
+                u = URL.query.filter_by(url=url).first()
+
+                if not u:
+                    u = URL(url)
+                    db.session.add(u)
+                    db.session.commit()
+
+                return u
+
+        # One atomic round-trip; concurrent shorteners of the same URL
+        # can no longer race each other into a constraint violation
+        stmt = stmt.values(url=url)\
+            .on_conflict_do_nothing(index_elements=["url"])\
+            .returning(URL.id)
+        id = db.session.execute(stmt).scalar()
+
+        if id is None:
+            # Conflict: the URL is already stored
+            id = db.session.execute(
+                db.select(URL.id).where(URL.url == url)).scalar_one()
 
-        if not u:
-            u = URL(url)
-            db.session.add(u)
-            db.session.commit()
+        db.session.commit()
 
+        u = URL(url)
+        u.id = id
         return u
 
 
@@ -158,24 +247,67 @@ class IPAddress(types.TypeDecorator):
         return value
 
 
+# Process umask, for giving files created via mkstemp (0600) the mode
+# a plain open() would have produced
+_umask = os.umask(0)
+os.umask(_umask)
+
+_scratch = threading.local()
+
+
+def _scratch_buf() -> memoryview:
+    # 1 MiB per-thread read buffer, reused across uploads so the chunk
+    # loops allocate nothing
+    buf = getattr(_scratch, "buf", None)
+    if buf is None:
+        buf = _scratch.buf = memoryview(bytearray(1 << 20))
+    return buf
+
+
+def guess_ext(name: str, mime: str) -> str:
+    ext = "".join(Path(name).suffixes[-2:])
+    if len(ext) > app.config["FHOST_MAX_EXT_LENGTH"]:
+        ext = Path(name).suffixes[-1]
+    gmime = mime.split(";")[0]
+    guess = guess_extension(gmime)
+
+    app.logger.debug(f"extension - specified: '{ext}' - detected: "
+                     f"'{guess}'")
+
+    if not ext:
+        if gmime in app.config["FHOST_EXT_OVERRIDE"]:
+            ext = app.config["FHOST_EXT_OVERRIDE"][gmime]
+        elif guess:
+            ext = guess
+        else:
+            ext = ""
+
+    return ext[:app.config["FHOST_MAX_EXT_LENGTH"]] or ".bin"
+
+
 class TransferFile():
     def __init__(self, stream, name, content_type):
         self.stream = stream
         self.name = name
-        self.sha256 = file_digest(stream, "sha256").hexdigest()
-
-        stream.seek(0, os.SEEK_END)
-        self.size = stream.tell()
-        stream.seek(0)
+        self.sha256 = None
+        self.size = None
+
+        # libmagic resolves virtually all signatures from the first few
+        # KiB, so there is no point in handing it the whole file.
+        if stream.seekable():
+            stream.seek(0)
+            self._head = stream.read(4096)
+            stream.seek(0)
+        else:
+            # Non-seekable streams (e.g. a remote body in store_url) get
+            # their head replayed by save_and_hash instead.
+            self._head = stream.read(4096)
 
         self.mime, self.mime_detected = self.get_mime(content_type)
         self.ext = self.get_ext()
 
     def get_mime(self, content_type):
-        try:
-            guess = mimedetect.from_descriptor(self.stream.fileno())
-        except io.UnsupportedOperation:
-            guess = mimedetect.from_buffer(self.stream.getvalue())
+        guess = mimedetect().from_buffer(self._head)
 
         app.logger.debug(f"MIME - specified: '{content_type}' - "
                          f"detected: '{guess}'")
@@ -193,28 +325,62 @@ class TransferFile():
         return mime, guess
 
     def get_ext(self):
-        ext = "".join(Path(self.name).suffixes[-2:])
-        if len(ext) > app.config["FHOST_MAX_EXT_LENGTH"]:
-            ext = Path(self.name).suffixes[-1]
-        gmime = self.mime.split(";")[0]
-        guess = guess_extension(gmime)
-
-        app.logger.debug(f"extension - specified: '{ext}' - detected: "
-                         f"'{guess}'")
-
-        if not ext:
-            if gmime in app.config["FHOST_EXT_OVERRIDE"]:
-                ext = app.config["FHOST_EXT_OVERRIDE"][gmime]
-            elif guess:
-                ext = guess
-            else:
-                ext = ""
+        return guess_ext(self.name, self.mime)
+
+    """
+    Hash the stream and write it to disk in a single pass
+
+    The data is written to a temporary file in the storage directory and
+    only moved to its content-addressed path once the digest is known.
+    If a file with the same digest is already present, the temporary file
+    is discarded instead. Sets sha256 and size as a side effect and
+    returns the final path.
+    """
+    def save_and_hash(self, storage: Path) -> Path:
+        h = _sha256()
+        size = 0
+        buf = _scratch_buf()
+        max_len = app.config["MAX_CONTENT_LENGTH"]
 
-        return ext[:app.config["FHOST_MAX_EXT_LENGTH"]] or ".bin"
+        fd, tmp = tempfile.mkstemp(dir=storage)
+        try:
+            # mkstemp creates 0600, which the web server (a different
+            # user on X-Accel deployments) couldn't read after the
+            # rename
+            os.fchmod(fd, 0o666 & ~_umask)
+
+            with os.fdopen(fd, "wb") as of:
+                if self.stream.seekable():
+                    self.stream.seek(0)
+                else:
+                    # The head buffer was already consumed from the
+                    # stream, so replay it
+                    h.update(self._head)
+                    of.write(self._head)
+                    size = len(self._head)
+
+                while n := self.stream.readinto(buf):
+                    h.update(buf[:n])
+                    of.write(buf[:n])
+                    size += n
+
+                    if size > max_len:
+                        abort(413)
+        except:
+            os.unlink(tmp)
+            raise
+
+        self.sha256 = h.hexdigest()
+        self.size = size
+
+        p = storage / self.sha256
+
+        if p.is_file():
+            os.unlink(tmp)
+        else:
+            os.replace(tmp, p)
 
-    def save(self, path: os.PathLike):
-        with open(path, "wb") as of:
-            shutil.copyfileobj(self.stream, of)
+        return p
 
 
 class File(db.Model):
@@ -232,6 +398,13 @@ class File(db.Model):
     last_vscan = db.Column(db.DateTime)
     size = db.Column(db.BigInteger)
     filename = db.Column(db.UnicodeText)
+    short_name = db.Column(db.String(16), unique=True, index=True)
+
+    __table_args__ = (
+        db.Index("file_exp_idx", expiration,
+                 sqlite_where=expiration.is_not(None),
+                 postgresql_where=expiration.is_not(None)),
+    )
 
     def __init__(self, file_: TransferFile, addr, ua, expiration, mgmt_token):
         self.sha256 = file_.sha256
@@ -250,19 +423,26 @@ class File(db.Model):
         return False
 
     def getname(self):
-        return u"{0}{1}".format(su.enbase(self.id), self.ext)
+        return u"{0}{1}".format(self.short_name or su.enbase(self.id),
+                                self.ext)
 
     def geturl(self):
         n = self.getname()
-        a = "nsfw" if self.is_nsfw else None
 
         if self.filename:
-            path = f"{n}/{self.filename}"
+            path = f"{n}/{quote(self.filename)}"
         else:
             path = n
 
-        return url_for("get", path=path, secret=self.secret,
-                       _external=True, _anchor=a) + "\n"
+        if self.secret:
+            path = f"s/{self.secret}/{path}"
+
+        url = f"{external_base()}/{path}"
+
+        if self.is_nsfw:
+            url += "#nsfw"
+
+        return url + "\n"
 
     def getpath(self) -> Path:
         return Path(app.config["FHOST_STORAGE_PATH"]) / self.sha256
@@ -321,9 +501,12 @@ class File(db.Model):
         if len(file_.mime) > 128:
             abort(400)
 
-        for flt in MIMEFilter.query.all():
-            if flt.check(file_.mime_detected):
-                abort(403, flt.reason)
+        if reason := match_mime_filter(file_.mime_detected):
+            abort(403, reason)
+
+        storage = Path(app.config["FHOST_STORAGE_PATH"])
+        storage.mkdir(parents=True, exist_ok=True)
+        p = file_.save_and_hash(storage)
 
         expiration = File.get_expiration(requested_expiration, file_.size)
         isnew = True
@@ -333,19 +516,20 @@ class File(db.Model):
             # If the file already exists
             if f.removed:
                 # The file was removed by moderation, so don't accept it back
+                p.unlink(missing_ok=True)
                 abort(451)
             if f.expiration is None:
                 # The file has expired, so give it a new expiration date
                 f.expiration = expiration
 
                 # Also generate a new management token
-                f.mgmt_token = secrets.token_urlsafe()
+                f.mgmt_token = _tokens.get()
             else:
                 # The file already exists, update the expiration if needed
                 f.expiration = max(f.expiration, expiration)
                 isnew = False
         else:
-            mgmt_token = secrets.token_urlsafe()
+            mgmt_token = _tokens.get()
             f = File(file_, addr, ua, expiration, mgmt_token)
 
         f.addr = addr
@@ -355,22 +539,23 @@ class File(db.Model):
             f.secret = None
             if secret:
                 f.secret = \
-                    secrets.token_urlsafe(app.config["FHOST_SECRET_BYTES"])
-
-        storage = Path(app.config["FHOST_STORAGE_PATH"])
-        storage.mkdir(parents=True, exist_ok=True)
-        p = storage / file_.sha256
-
-        if not p.is_file():
-            file_.save(p)
+                    _tokens.get(app.config["FHOST_SECRET_BYTES"])
 
         f.size = file_.size
 
-        if not f.nsfw_score and app.config["NSFW_DETECT"]:
-            f.nsfw_score = nsfw.detect(str(p))
-
         db.session.add(f)
+
+        if f.short_name is None:
+            # The short name is derived from the row id, which only
+            # exists once the insert has been flushed
+            db.session.flush()
+            f.short_name = su.enbase(f.id)
+
         db.session.commit()
+
+        if f.nsfw_score is None and app.config["NSFW_DETECT"]:
+            scan_pool().submit(_scan_file, f.id, str(p))
+
         return f, isnew
 
 
@@ -454,12 +639,18 @@ class NetFilter(RequestFilter):
 
 
 class HasRegex:
+    # compiled pattern, cached per instance on first use so neither
+    # fresh nor DB-loaded filters pay re's cache lookup on every check
+    _re = None
+
     @declared_attr
     def regex(cls):
         return cls.__table__.c.get("regex", db.Column(db.UnicodeText))
 
     def check(self, s: str) -> bool:
-        return re.match(self.regex, s) is not None
+        if self._re is None:
+            self._re = re.compile(self.regex)
+        return self._re.match(s) is not None
 
 
 class MIMEFilter(HasRegex, RequestFilter):
@@ -495,25 +686,147 @@ class UAFilter(HasRegex, RequestFilter):
         return "User agent not allowed."
 
 
+_filter_cache = {
+    "stamp": None,
+    "addr": [],    # [(address, reason)]
+    "net": [],     # [(network, reason)]
+    "mime": None,  # (compiled union regex, reason)
+    "ua": None,
+}
+
+
+def touch_filters():
+    """Force the request filter cache to be reloaded on next use."""
+    _filter_cache["stamp"] = None
+
+
+"""
+Load the request filters into the in-process cache
+
+Re-querying and re-instantiating every polymorphic filter row on each
+upload is pure overhead, so the rules are kept as plain tuples and the
+regex filters are pre-compiled into one union pattern per class. A cheap
+(count, max id) probe detects edits made by other processes (e.g. the
+moderation UI) and triggers a reload.
+"""
+def load_filters():
+    stamp = db.session.query(db.func.count(RequestFilter.id),
+                             db.func.max(RequestFilter.id)).one()
+
+    if stamp == _filter_cache["stamp"]:
+        return
+
+    addr, net, mime, ua = [], [], [], []
+    for flt in RequestFilter.query.all():
+        match flt:
+            case AddrFilter():
+                addr.append((flt.addr, flt.reason))
+            case NetFilter():
+                net.append((flt.net, flt.reason))
+            case MIMEFilter():
+                mime.append(flt)
+            case UAFilter():
+                ua.append(flt)
+
+    def union(flts):
+        if not flts:
+            return None
+        return (re.compile("|".join(f"(?:{f.regex})" for f in flts)),
+                flts[0].reason)
+
+    _filter_cache.update(stamp=stamp, addr=addr, net=net,
+                         mime=union(mime), ua=union(ua))
+
+
+def check_request_filters(r: Request):
+    load_filters()
+
+    addr = ipaddress.ip_address(r.remote_addr)
+    if type(addr) is ipaddress.IPv6Address:
+        addr = addr.ipv4_mapped or addr
+
+    for faddr, reason in _filter_cache["addr"]:
+        if addr == faddr:
+            abort(403, reason)
+
+    for net, reason in _filter_cache["net"]:
+        if addr in net:
+            abort(403, reason)
+
+    if mime := _filter_cache["mime"]:
+        if "file" in r.files and mime[0].match(r.files["file"].mimetype):
+            abort(403, mime[1])
+
+    if ua := _filter_cache["ua"]:
+        if ua[0].match(r.user_agent.string):
+            abort(403, ua[1])
+
+
+"""
+Return the 403 reason of a MIME filter matching the given type, if any
+
+The match is pushed down to the database where the dialect supports
+regular expressions, so the cost stays constant no matter how many
+rules an instance has accumulated. The cached union pattern is
+consulted first so the common no-rules case costs no query at all, and
+serves as the fallback on dialects without a regex operator.
+"""
+def match_mime_filter(mime: str):
+    load_filters()
+
+    if not _filter_cache["mime"]:
+        return None
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        crit = literal(mime).op("REGEXP")(MIMEFilter.regex)
+    elif dialect == "postgresql":
+        # anchor the whole pattern to keep re.match semantics; a bare
+        # "^" prefix would only anchor the first top-level alternative
+        crit = literal(mime).op("~")(literal("^(?:") + MIMEFilter.regex
+                                     + literal(")"))
+    else:
+        if _filter_cache["mime"][0].match(mime):
+            return _filter_cache["mime"][1]
+        return None
+
+    flt = MIMEFilter.query.filter(crit).first()
+    return flt.reason if flt else None
+
+
 class UrlEncoder(object):
     def __init__(self, alphabet, min_length):
         self.alphabet = alphabet
         self.min_length = min_length
+        self._n = len(alphabet)
+        self._enc = alphabet.encode("ascii")
+
+        # char -> value table; 0xff marks characters outside the alphabet
+        self._lut = bytearray(b"\xff" * 256)
+        for i, c in enumerate(self._enc):
+            self._lut[c] = i
 
     def enbase(self, x):
-        n = len(self.alphabet)
-        str = ""
+        n = self._n
+        enc = self._enc
+        out = bytearray()
         while x > 0:
-            str = (self.alphabet[int(x % n)]) + str
-            x = int(x // n)
-        padding = self.alphabet[0] * (self.min_length - len(str))
-        return '%s%s' % (padding, str)
+            out.append(enc[x % n])
+            x //= n
+        while len(out) < self.min_length:
+            out.append(enc[0])
+        out.reverse()
+        return out.decode("ascii")
 
     def debase(self, x):
-        n = len(self.alphabet)
+        n = self._n
+        lut = self._lut
         result = 0
-        for i, c in enumerate(reversed(x)):
-            result += self.alphabet.index(c) * (n ** i)
+        for c in x.encode("ascii"):
+            v = lut[c]
+            if v == 0xff:
+                raise ValueError(f"invalid character in encoded id: {x!r}")
+            result = result * n + v
         return result
 
 
@@ -531,6 +844,21 @@ def is_fhost_url(url):
     return url.startswith(fhost_url()) or url.startswith(fhost_url("https"))
 
 
+"""
+The external URL base never changes for a deployment, but url_for
+re-derives it (and walks the URL map) on every call. Build it from
+configuration instead — never from a request, whose Host header the
+client controls. Deployments without SERVER_NAME fall back to
+per-request url_for, uncached.
+"""
+def external_base() -> str:
+    if app.config["SERVER_NAME"]:
+        return (f"{app.config['PREFERRED_URL_SCHEME']}://"
+                f"{app.config['SERVER_NAME']}")
+
+    return fhost_url()
+
+
 def shorten(url):
     if len(url) > app.config["MAX_URL_LENGTH"]:
         abort(414)
@@ -543,6 +871,45 @@ def shorten(url):
     return u.geturl()
 
 
+_scan_pool = None
+
+
+def _scan_worker_init():
+    # Forked workers must not reuse the parent's pooled DB connections
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+"""
+Runs in a scan pool worker: scores a freshly stored file and updates
+its row using a session of the worker's own
+"""
+def _scan_file(file_id: int, path: str):
+    with app.app_context():
+        f = db.session.get(File, file_id)
+
+        if f is None or f.nsfw_score is not None:
+            return
+
+        f.nsfw_score = nsfw.detect(path)
+        db.session.commit()
+
+
+"""
+NSFW detection runs an ML inference that can take seconds per image, so
+it happens in a small process pool instead of on the request thread.
+Until the score lands, is_nsfw treats the file as clean — the same
+answer the synchronous path gave before the model had run. Virus
+scanning already happens out of band via the vscan timer.
+"""
+def scan_pool() -> ProcessPoolExecutor:
+    global _scan_pool
+    if _scan_pool is None:
+        _scan_pool = ProcessPoolExecutor(max_workers=1,
+                                         initializer=_scan_worker_init)
+    return _scan_pool
+
+
 """
 requested_expiration can be:
     - None, to use the longest allowed file lifespan
@@ -566,6 +933,48 @@ def store_file(f: TransferFile, requested_expiration: typing.Optional[int],
     return response
 
 
+"""
+Answer a duplicate upload from a client-supplied Digest header
+
+If the request carries "Digest: sha-256=<hex>" and a live copy of that
+file is already stored, bump its expiration and return the usual
+response without hashing or saving the body again. Returns None when
+the digest is malformed or unknown, in which case the regular upload
+path (which verifies the digest by computing it) takes over.
+"""
+def dedup_upload(digest):
+    m = re.fullmatch(r"sha-256=([0-9a-f]{64})", digest)
+    if not m:
+        return None
+
+    f = File.query.filter_by(sha256=m.group(1)).first()
+
+    if not f or f.removed or f.expiration is None \
+            or not f.getpath().is_file():
+        return None
+
+    if f.secret:
+        # Never answer from the digest alone: the response would hand
+        # out the unguessable URL to anyone who merely knows the hash.
+        # The normal path requires the actual bytes.
+        return None
+
+    try:
+        requested_expiration = int(request.form["expires"])
+    except ValueError:
+        abort(400)
+    except KeyError:
+        requested_expiration = None
+
+    f.expiration = max(f.expiration,
+                       File.get_expiration(requested_expiration, f.size))
+    db.session.commit()
+
+    response = make_response(f.geturl())
+    response.headers["X-Expires"] = f.expiration
+    return response
+
+
 def store_url(url, addr, ua, secret: bool):
     if is_fhost_url(url):
         abort(400)
@@ -578,18 +987,11 @@ def store_url(url, addr, ua, secret: bool):
     except requests.exceptions.HTTPError as e:
         return str(e) + "\n"
 
-    if "content-length" in r.headers:
-        length = int(r.headers["content-length"])
+    r.raw.decode_content = True
+    name = Path(urlsplit(url).path).name
+    tf = TransferFile(r.raw, name, r.headers.get("content-type", ""))
 
-        if length <= app.config["MAX_CONTENT_LENGTH"]:
-            tf = TransferFile(io.BytesIO(r.raw.read()),
-                              r.headers["content-type"], "")
-
-            return store_file(tf, None, addr, ua, secret)
-        else:
-            abort(413)
-    else:
-        abort(411)
+    return store_file(tf, None, addr, ua, secret)
 
 
 def manage_file(f):
@@ -623,10 +1025,8 @@ def get(path, secret=None):
     if "." in name:
         abort(404)
 
-    id = su.debase(name)
-
     if sufs:
-        f = File.query.get(id)
+        f = File.query.filter_by(short_name=name).first()
 
         if f and f.ext == sufs:
             if f.secret != secret:
@@ -643,16 +1043,37 @@ def get(path, secret=None):
             if request.method == "POST":
                 return manage_file(f)
 
-            if app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
+            # Content is addressed by its digest, so the hash is a
+            # strong validator and cached copies never go stale
+            if request.if_none_match.contains(f.sha256):
+                response = Response(status=304)
+            elif app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
+                # nginx answers conditional and Range requests for the
+                # redirected response itself
                 response = make_response()
                 response.headers["Content-Type"] = f.mime
                 response.headers["Content-Length"] = f.size
                 response.headers["X-Accel-Redirect"] = "/" + str(fpath)
             else:
-                response = send_from_directory(
-                    app.config["FHOST_STORAGE_PATH"], f.sha256,
-                    mimetype=f.mime)
-
+                wrapper = request.environ.get("wsgi.file_wrapper")
+                if wrapper:
+                    # Hand the open file to the WSGI server's wrapper,
+                    # which hits sendfile(2) on servers that support it
+                    # instead of copying chunks through Python
+                    response = app.response_class(
+                        wrapper(open(fpath, "rb"), 65536),
+                        mimetype=f.mime, direct_passthrough=True)
+                    response.headers["Content-Length"] = f.size
+                    response.make_conditional(request, accept_ranges=True,
+                                              complete_length=f.size)
+                else:
+                    response = send_from_directory(
+                        app.config["FHOST_STORAGE_PATH"], f.sha256,
+                        mimetype=f.mime)
+
+            response.headers["ETag"] = f'"{f.sha256}"'
+            response.headers["Cache-Control"] = \
+                "public, max-age=31536000, immutable"
             response.headers["X-Expires"] = f.expiration
             return response
     else:
@@ -662,6 +1083,11 @@ def get(path, secret=None):
         if "/" in path:
             abort(404)
 
+        try:
+            id = su.debase(name)
+        except ValueError:
+            abort(404)
+
         u = URL.query.get(id)
 
         if u:
@@ -670,12 +1096,42 @@ def get(path, secret=None):
     abort(404)
 
 
+_index_cache = {"stamp": None, "body": None}
+
+
+"""
+Serve the landing page from an in-process render cache
+
+Running the full Jinja render on every hit of the busiest endpoint is
+wasted work; the page only changes when the file table does, so the
+rendered bytes are kept until a cheap (count, max id) probe — the same
+trick the filter cache uses — says the listing is stale. The absolute
+URLs in the page come from the config-derived base, never from the
+triggering request; without SERVER_NAME there is no canonical base, so
+the page is rendered per request instead of cached.
+"""
+def index_page() -> Response:
+    if not app.config["SERVER_NAME"]:
+        return make_response(render_template("index.html",
+                                             files=File.query.all(),
+                                             fhost_url=fhost_url()))
+
+    stamp = db.session.query(db.func.count(File.id),
+                             db.func.max(File.id)).one()
+
+    if stamp != _index_cache["stamp"]:
+        _index_cache["body"] = render_template("index.html",
+                                               files=File.query.all(),
+                                               fhost_url=external_base())
+        _index_cache["stamp"] = stamp
+
+    return make_response(_index_cache["body"])
+
+
 @app.route("/", methods=["GET", "POST"])
 def fhost():
     if request.method == "POST":
-        for flt in RequestFilter.query.all():
-            if flt.check_request(request):
-                abort(403, flt.reason)
+        check_request_filters(request)
 
         sf = None
         secret = "secret" in request.form
@@ -684,6 +1140,15 @@ def fhost():
             addr = addr.ipv4_mapped or addr
 
         if "file" in request.files:
+            # If the client told us the file's digest up front, a
+            # re-upload of something we already have can be answered
+            # without reading the body at all
+            digest = request.headers.get("Digest")
+            if digest:
+                resp = dedup_upload(digest)
+                if resp:
+                    return resp
+
             f = request.files["file"]
             tf = TransferFile(f.stream, f.filename, f.content_type)
 
@@ -720,7 +1185,7 @@ def fhost():
 
         abort(400)
     else:
-        return render_template("index.html", files=File.query.all())
+        return index_page()
 
 
 @app.route("/clipboard", methods=["GET", "POST"])
@@ -775,43 +1240,67 @@ def prune():
     # The path to where uploaded files are stored
     storage = Path(app.config["FHOST_STORAGE_PATH"])
 
-    # A list of all files who've passed their expiration times
-    expired_files = File.query\
-        .where(
-            and_(
-                File.expiration.is_not(None),
-                File.expiration < current_time
-            )
-        )
-
     files_removed = 0
 
-    # For every expired file...
-    for file in expired_files:
-        # Log the file we're about to remove
-        file_name = file.getname()
-        file_hash = file.sha256
-        file_path = storage / file_hash
-        print(f"Removing expired file {file_name} [{file_hash}]")
+    def unlink(file):
+        print(f"Removing expired file {file.getname()} [{file.sha256}]")
 
-        # Remove it from the file system
         try:
-            os.remove(file_path)
-            files_removed += 1
+            os.remove(storage / file.sha256)
         except FileNotFoundError:
-            pass  # If the file was already gone, we're good
+            return None  # If the file was already gone, we're good
         except OSError as e:
             print(e)
             print(
                 "\n------------------------------------"
-                "Encountered an error while trying to remove file {file_path}."
-                "Make sure the server is configured correctly, permissions "
-                "are okay, and everything is ship shape, then try again.")
-            return
+                f"Encountered an error while trying to remove file "
+                f"{storage / file.sha256}. Make sure the server is "
+                "configured correctly, permissions are okay, and "
+                "everything is ship shape, then try again.")
+            return False
+
+        return True
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Fetch expired rows in LIMIT-sized batches rather than holding one
+    # long-running cursor over the whole backlog; the partial index on
+    # expiration makes each fetch a range scan. Rows whose unlink failed
+    # are excluded from refetches so the loop always terminates.
+    failed = []
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        while True:
+            q = File.query\
+                .where(
+                    and_(
+                        File.expiration.is_not(None),
+                        File.expiration < current_time
+                    )
+                )
 
-        # Finally, mark that the file was removed
-        file.expiration = None
-    db.session.commit()
+            if failed:
+                q = q.where(File.id.not_in(failed))
+
+            batch = q.limit(1000).all()
+
+            if not batch:
+                break
+
+            # Unlinks are I/O-latency-bound and release the GIL, so run
+            # each batch in parallel
+            results = list(pool.map(unlink, batch))
+            failed.extend(f.id for f, ok in zip(batch, results)
+                          if ok is False)
+            removed = [f.id for f, ok in zip(batch, results)
+                       if ok is not False]
+            files_removed += sum(1 for ok in results if ok)
+
+            # Mark the batch as removed with a single statement instead
+            # of accumulating per-row assignments in the session
+            db.session.execute(db.update(File)
+                               .where(File.id.in_(removed))
+                               .values(expiration=None))
+            db.session.commit()
 
     print(f"\nDone!  {files_removed} file(s) removed")
 
@@ -891,3 +1380,95 @@ def vscan():
 
         db.session.bulk_update_mappings(File, results)
         db.session.commit()
+
+
+def _hash_and_sniff(path):
+    h = _sha256()
+    size = 0
+    buf = _scratch_buf()
+
+    with open(path, "rb") as f:
+        head = f.read(4096)
+        h.update(head)
+        size = len(head)
+
+        while n := f.readinto(buf):
+            h.update(buf[:n])
+            size += n
+
+    mime = mimedetect().from_buffer(head)
+    if mime.startswith("text/") and "charset" not in mime:
+        mime += "; charset=utf-8"
+
+    return {"path": path, "sha256": h.hexdigest(), "size": size,
+            "mime": mime}
+
+
+@app.cli.command("import")
+@click.argument("directory",
+                type=click.Path(exists=True, file_okay=False,
+                                path_type=Path))
+def import_files(directory):
+    """
+    Bulk-import existing files into the database
+
+    Hashes and MIME-sniffs every file in the given directory across all
+    CPU cores, links the content into the storage path and inserts the
+    rows in batches. Files whose digest is already known are skipped.
+    Each imported file gets the maximum lifespan for its size, as if it
+    had just been uploaded.
+    """
+    import shutil
+    from multiprocessing import Pool, cpu_count
+    from itertools import islice
+
+    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    storage.mkdir(parents=True, exist_ok=True)
+
+    paths = [p for p in directory.iterdir() if p.is_file()]
+    imported = 0
+
+    with Pool(cpu_count()) as pool:
+        results = pool.imap_unordered(_hash_and_sniff, paths, chunksize=16)
+
+        while batch := list(islice(results, 1000)):
+            known = set(db.session.scalars(
+                db.select(File.sha256)
+                .where(File.sha256.in_([r["sha256"] for r in batch]))))
+
+            rows = []
+            for r in batch:
+                if r["sha256"] in known:
+                    print(f"Skipping {r['path']} [{r['sha256']}]: "
+                          "already stored")
+                    continue
+                known.add(r["sha256"])
+
+                p = storage / r["sha256"]
+                if not p.is_file():
+                    try:
+                        os.link(r["path"], p)
+                    except OSError:
+                        shutil.copyfile(r["path"], p)
+
+                rows.append({
+                    "sha256": r["sha256"],
+                    "ext": guess_ext(r["path"].name, r["mime"]),
+                    "mime": r["mime"],
+                    "size": r["size"],
+                    "filename": r["path"].name,
+                    "expiration": File.get_expiration(None, r["size"]),
+                    "mgmt_token": _tokens.get(),
+                })
+
+            db.session.bulk_insert_mappings(File, rows)
+            db.session.commit()
+            imported += len(rows)
+
+            # bulk inserts bypass the flush-then-set step in File.store
+            names = [{"id": f.id, "short_name": su.enbase(f.id)}
+                     for f in File.query.filter_by(short_name=None)]
+            db.session.bulk_update_mappings(File, names)
+            db.session.commit()
+
+    print(f"\nDone!  {imported} file(s) imported")
@@ -0,0 +1,60 @@
+"""add file short name
+
+Revision ID: 8c2b1f4d5a31
+Revises: 595590b37fee
+Create Date: 2026-08-28 11:41:02.518274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c2b1f4d5a31'
+down_revision = '595590b37fee'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.ext.automap import automap_base
+from sqlalchemy.orm import Session
+from flask import current_app
+
+Base = automap_base()
+
+
+def upgrade():
+    op.add_column('file', sa.Column('short_name', sa.String(length=16),
+                                    nullable=True))
+    bind = op.get_bind()
+    Base.prepare(autoload_with=bind)
+    File = Base.classes.file
+    session = Session(bind=bind)
+
+    alphabet = current_app.config["URL_ALPHABET"]
+    n = len(alphabet)
+
+    def enbase(x):
+        out = ""
+        while x > 0:
+            out = alphabet[x % n] + out
+            x //= n
+        return out or alphabet[0]
+
+    updates = []
+    for fid in session.scalars(sa.select(File.id)):
+        updates.append({
+            "id": fid,
+            "short_name": enbase(fid)
+        })
+
+    session.bulk_update_mappings(File, updates)
+    session.commit()
+
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.create_unique_constraint("uq_file_short_name",
+                                          ["short_name"])
+        batch_op.create_index("ix_file_short_name", ["short_name"])
+
+
+def downgrade():
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.drop_index("ix_file_short_name")
+        batch_op.drop_constraint("uq_file_short_name")
+    op.drop_column('file', 'short_name')
@@ -0,0 +1,26 @@
+"""index file expiration
+
+Revision ID: b7a51e3c9f02
+Revises: 8c2b1f4d5a31
+Create Date: 2026-08-28 15:27:46.903112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7a51e3c9f02'
+down_revision = '8c2b1f4d5a31'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Partial index so the prune query is a range scan over live rows
+    # only; expired rows (expiration NULL) stay out of the index
+    op.create_index('file_exp_idx', 'file', ['expiration'],
+                    sqlite_where=sa.text('expiration IS NOT NULL'),
+                    postgresql_where=sa.text('expiration IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('file_exp_idx', 'file')